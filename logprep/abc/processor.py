@@ -265,20 +265,26 @@ class Processor(Component):
     def _apply_rules_wrapper(self, event: dict, rule: "Rule"):
         try:
             self._apply_rules(event, rule)
-        except ProcessingWarning as error:
-            self._handle_warning_error(event, rule, error)
-        except ProcessingCriticalError as error:
-            self.result.errors.append(error)  # is needed to prevent wrapping it in itself
-            event.clear()
         except Exception as error:  # pylint: disable=broad-except
-            self.result.errors.append(ProcessingCriticalError(str(error), rule))
-            event.clear()
+            self._handle_rule_error(event, rule, error)
         if not hasattr(rule, "delete_source_fields"):
             return
         if rule.delete_source_fields:
             for dotted_field in rule.source_fields:
                 pop_dotted_field_value(event, dotted_field)
 
+    def _handle_rule_error(self, event: dict, rule: "Rule", error: Exception):
+        """Handles an error raised while applying a rule: warnings are logged, any other error
+        is reported as critical error and clears the event."""
+        if isinstance(error, ProcessingWarning):
+            self._handle_warning_error(event, rule, error)
+        elif isinstance(error, ProcessingCriticalError):
+            self.result.errors.append(error)  # is needed to prevent wrapping it in itself
+            event.clear()
+        else:
+            self.result.errors.append(ProcessingCriticalError(str(error), rule))
+            event.clear()
+
     @abstractmethod
     def _apply_rules(self, event, rule): ...  # pragma: no cover
 
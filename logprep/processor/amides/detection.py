@@ -1,14 +1,32 @@
 """This module contains classes for misuse detection and rule attribution
 as used by AMIDES."""
 
-from typing import Dict, List, Tuple
+from copy import copy
+from typing import Dict, Iterable, List, Optional, Tuple
 
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
 from sklearn.base import BaseEstimator
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.preprocessing import MinMaxScaler
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.preprocessing import MinMaxScaler, normalize
 
 from logprep.processor.amides.features import CommaSeparation
 
+ANALYSIS_PARAMS = (
+    "analyzer",
+    "lowercase",
+    "preprocessor",
+    "strip_accents",
+    "stop_words",
+    "ngram_range",
+)
+"""Vectorizer parameters that determine how samples are split into features."""
+
+
+def _analyzed(sample: List[str]) -> List[str]:
+    """Analyzer for vectorizers that receive already analyzed samples."""
+    return sample
+
 
 class DetectionModelError(Exception):
     """Base exception class for all RuleModel-related errors."""
@@ -25,11 +43,25 @@ class DetectionModel:
     """DetectionModel combines vectorizer fitted used taining data and classifier
     trained on same data to detect malicious data samples."""
 
-    __slots__ = ("_clf", "_vectorizer", "_scaler")
+    __slots__ = (
+        "_clf",
+        "_vectorizer",
+        "_scaler",
+        "_analyzer",
+        "_analysis_params",
+        "_idf",
+        "_coef",
+        "_intercept",
+    )
 
     _clf: BaseEstimator
     _vectorizer: TfidfVectorizer
-    _scaler: MinMaxScaler
+    _scaler: Optional[MinMaxScaler]
+    _analyzer: callable
+    _analysis_params: tuple
+    _idf: Optional[np.ndarray]
+    _coef: Optional[np.ndarray]
+    _intercept: Optional[float]
 
     def __init__(self, misuse_model: dict):
         self._setup(misuse_model)
@@ -43,6 +75,95 @@ class DetectionModel:
         except KeyError as err:
             raise MissingModelComponentError(err.args[0]) from err
 
+        vectorizer_params = self._vectorizer.get_params()
+        self._analysis_params = tuple(vectorizer_params.get(name) for name in ANALYSIS_PARAMS)
+        self._analyzer = self._vectorizer.build_analyzer()
+        # Transform on a private copy, as the vectorizer may be shared with other models
+        self._vectorizer = copy(self._vectorizer)
+        self._vectorizer.analyzer = _analyzed
+        self._idf = self._get_idf_weights()
+        self._coef, self._intercept = self._get_linear_decision_function()
+        self._fuse_scaler()
+
+    def _get_idf_weights(self) -> Optional[np.ndarray]:
+        """Returns the idf weights of tf-idf vectorizers using l2 normalization as contiguous
+        array. Scaling term counts by these weights directly is considerably faster than the
+        sparse matrix product the vectorizer performs on each transform."""
+        vectorizer = self._vectorizer
+        if not isinstance(vectorizer, TfidfVectorizer):
+            return None
+        if not vectorizer.use_idf or vectorizer.sublinear_tf or vectorizer.norm != "l2":
+            return None
+
+        return np.ascontiguousarray(vectorizer.idf_, dtype=np.float64)
+
+    def _get_linear_decision_function(self) -> Tuple[Optional[np.ndarray], Optional[float]]:
+        """Returns weights and intercept of binary linear classifiers. The decision function
+        of these classifiers can be computed by a single dot product instead of calling the
+        classifier, which e.g. evaluates support vectors in case of linear SVCs."""
+        if getattr(self._clf, "kernel", "linear") != "linear":
+            return None, None
+        coef = getattr(self._clf, "coef_", None)
+        intercept = getattr(self._clf, "intercept_", None)
+        if coef is None or intercept is None or coef.shape[0] != 1:
+            return None, None
+        if issparse(coef):
+            coef = coef.toarray()
+
+        return np.ascontiguousarray(coef).ravel(), intercept[0].item()
+
+    def _fuse_scaler(self):
+        """Folds min-max scalers into the weights and intercept of linear decision functions.
+        Since scaling is affine, scaled confidence values can then be computed by the dot
+        product alone."""
+        scaler = self._scaler
+        if self._coef is None or not isinstance(scaler, MinMaxScaler) or scaler.clip:
+            return
+        if np.size(scaler.scale_) != 1:
+            return
+
+        scale, offset = np.ravel(scaler.scale_)[0].item(), np.ravel(scaler.min_)[0].item()
+        self._coef = self._coef * scale
+        self._intercept = self._intercept * scale + offset
+        self._scaler = None
+
+    @property
+    def analysis_params(self) -> tuple:
+        """Returns the vectorizer parameters used to analyze samples. Models with equal
+        analysis parameters can share analyzed samples."""
+        return self._analysis_params
+
+    @property
+    def vocabulary(self) -> Optional[dict]:
+        """Returns the vocabulary of the vectorizer or None if the vectorizer has none."""
+        return getattr(self._vectorizer, "vocabulary_", None)
+
+    def get_linear_weights(self) -> Optional[Tuple[np.ndarray, np.ndarray, float]]:
+        """Returns idf weights, decision function weights and intercept of models whose
+        confidence values are a linear function of the l2 normalized tf-idf vector of the
+        term counts, or None if confidence values are computed differently."""
+        if self._idf is None or self._coef is None or self._scaler is not None:
+            return None
+        if self._vectorizer.binary or self.vocabulary is None:
+            return None
+
+        return self._idf, self._coef, self._intercept
+
+    def analyze(self, sample: str) -> List[str]:
+        """Split sample into the list of tokens the vectorizer extracts features from.
+
+        Parameters
+        ----------
+        sample: str
+            Sample string to analyze.
+
+        Returns
+        -------
+        analyzed_sample: List[str]
+            List of tokens.
+        """
+        return self._analyzer(sample)
+
     def detect(self, sample: str) -> float:
         """Detect malicious data sample. Returns confidence value that estimates how likely
         given sample is malicious.
@@ -57,11 +178,55 @@ class DetectionModel:
         confidence_value: float
             Value between 0.0 and 1.0 that serves as confidence value.
         """
-        feature_vector = self._vectorizer.transform([sample])
-        df_value = self._clf.decision_function(feature_vector)
-        scaled_df_value = self._scaler.transform(df_value.reshape(-1, 1)).flatten()[0]
+        return self.detect_batch([sample])[0].item()
+
+    def detect_batch(self, samples: List[str]) -> np.ndarray:
+        """Detect malicious data samples. Vectorization, classification and scaling are
+        performed once for the whole batch of samples.
+
+        Parameters
+        ----------
+        samples: List[str]
+            Sample strings to evaluate.
+
+        Returns
+        -------
+        confidence_values: np.ndarray
+            Values between 0.0 and 1.0 that serve as confidence values, one for each sample.
+        """
+        return self.detect_analyzed([self._analyzer(sample) for sample in samples])
+
+    def detect_analyzed(self, analyzed_samples: List[List[str]]) -> np.ndarray:
+        """Detect malicious data samples that have already been analyzed.
+
+        Parameters
+        ----------
+        analyzed_samples: List[List[str]]
+            Token lists of the samples to evaluate.
+
+        Returns
+        -------
+        confidence_values: np.ndarray
+            Values between 0.0 and 1.0 that serve as confidence values, one for each sample.
+        """
+        feature_vectors = self._transform(analyzed_samples)
+        if self._coef is None:
+            df_values = self._clf.decision_function(feature_vectors)
+        else:
+            df_values = feature_vectors @ self._coef + self._intercept
+        if self._scaler is None:
+            return df_values
+
+        return self._scaler.transform(df_values.reshape(-1, 1)).flatten()
 
-        return scaled_df_value.item()
+    def _transform(self, analyzed_samples: List[List[str]]):
+        if self._idf is None:
+            return self._vectorizer.transform(analyzed_samples)
+
+        feature_vectors = CountVectorizer.transform(self._vectorizer, analyzed_samples)
+        feature_vectors = feature_vectors.astype(np.float64, copy=False)
+        feature_vectors.data *= self._idf[feature_vectors.indices]
+        return normalize(feature_vectors, norm="l2", copy=False)
 
 
 class MisuseDetector(DetectionModel):
@@ -91,11 +256,26 @@ class MisuseDetector(DetectionModel):
         predict: Tuple[boolean, float].
             Detection result as boolean value and the corresponding confidence.
         """
-        confidence_value = super().detect(sample)
+        malicious, confidence_values = self.detect_batch([sample])
+
+        return malicious[0].item(), confidence_values[0].item()
+
+    def detect_analyzed(self, analyzed_samples: List[List[str]]) -> Tuple[np.ndarray, np.ndarray]:
+        """Detect which of the given already analyzed samples are malicious.
+
+        Parameters
+        ----------
+        analyzed_samples: List[List[str]]
+            Token lists of the samples to evaluate.
+
+        Returns
+        -------
+        predict: Tuple[np.ndarray, np.ndarray]
+            Detection results as boolean array and the corresponding confidence values.
+        """
+        confidence_values = super().detect_analyzed(analyzed_samples)
 
-        if confidence_value >= self._decision_threshold:
-            return True, round(confidence_value, 3)
-        return False, round(confidence_value, 3)
+        return confidence_values >= self._decision_threshold, confidence_values.round(3)
 
 
 class RuleAttributorError(Exception):
@@ -105,10 +285,22 @@ class RuleAttributorError(Exception):
 class RuleAttributor:
     """RuleAttributor attributes malicious samples to misuse detection rules."""
 
-    __slots__ = ("_rule_models", "_num_rule_attributions", "_attribution_threshold")
+    __slots__ = (
+        "_rule_models",
+        "_num_rule_attributions",
+        "_attribution_threshold",
+        "_analysis_params",
+        "_rule_names",
+        "_vocabulary",
+        "_packed_weights",
+    )
 
     _rule_models: Dict[str, DetectionModel]
     _num_rule_attributions: int
+    _rule_names: List[str]
+    _analysis_params: Optional[tuple]
+    _vocabulary: Optional[Dict[str, int]]
+    _packed_weights: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]
 
     def __init__(
         self,
@@ -127,6 +319,84 @@ class RuleAttributor:
                 self._rule_models[rule_name] = rule_model
             except DetectionModelError as err:
                 raise RuleAttributorError from err
+        self._rule_names = list(self._rule_models.keys())
+
+        analysis_params = [model.analysis_params for model in self._rule_models.values()]
+        self._analysis_params = None
+        if analysis_params and analysis_params.count(analysis_params[0]) == len(analysis_params):
+            self._analysis_params = analysis_params[0]
+        self._vocabulary = self._get_vocabulary()
+        self._packed_weights = self._get_packed_weights()
+
+    def _get_vocabulary(self) -> Optional[Dict[str, int]]:
+        """Returns the union of the vocabularies of all rule models, mapping each token to
+        its index, if the rule models share their analysis parameters."""
+        if self._analysis_params is None:
+            return None
+        vocabularies = [model.vocabulary for model in self._rule_models.values()]
+        if any(vocabulary is None for vocabulary in vocabularies):
+            return None
+
+        tokens = sorted(frozenset().union(*vocabularies))
+        return {token: index for index, token in enumerate(tokens)}
+
+    def _get_packed_weights(self) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Packs the weights of linear tf-idf rule models into matrices over the union
+        vocabulary, which allows to compute the confidence values of all rule models for
+        a batch of term count vectors by two matrix products.
+
+        The first matrix contains the decision function weights multiplied by the idf
+        weights, the second one the squared idf weights of tokens known to a rule model,
+        which yield the l2 norms of the tf-idf vectors of each rule model. Returns None if
+        any of the rule models is not such a model."""
+        if self._vocabulary is None:
+            return None
+        rule_weights = [model.get_linear_weights() for model in self._rule_models.values()]
+        if any(weights is None for weights in rule_weights):
+            return None
+
+        shape = (len(self._rule_models), len(self._vocabulary))
+        weights = np.zeros(shape)
+        squared_idf = np.zeros(shape)
+        intercepts = np.empty(len(self._rule_models))
+        for index, (model, (idf, coef, intercept)) in enumerate(
+            zip(self._rule_models.values(), rule_weights)
+        ):
+            tokens, feature_indices = zip(*model.vocabulary.items())
+            feature_indices = np.array(feature_indices)
+            union_indices = np.array([self._vocabulary[token] for token in tokens])
+            weights[index, union_indices] = idf[feature_indices] * coef[feature_indices]
+            squared_idf[index, union_indices] = idf[feature_indices] ** 2
+            intercepts[index] = intercept
+
+        return np.ascontiguousarray(weights.T), np.ascontiguousarray(squared_idf.T), intercepts
+
+    @property
+    def analysis_params(self) -> Optional[tuple]:
+        """Returns the analysis parameters shared by all rule models or None if
+        rule models analyze samples differently."""
+        return self._analysis_params
+
+    def get_relevant_tokens(self, analyzed_sample: List[str]) -> Optional[Tuple[str, ...]]:
+        """Returns the tokens of an already analyzed sample that are contained in the
+        vocabulary of at least one rule model. Other tokens do not contribute to any feature
+        vector, so samples with equal relevant tokens are attributed equally.
+
+        Parameters
+        ----------
+        analyzed_sample: List[str]
+            Token list of the sample.
+
+        Returns
+        -------
+        relevant_tokens: Optional[Tuple[str, ...]]
+            Relevant tokens in order of the analyzed sample or None if the vocabularies of the
+            rule models are not known.
+        """
+        if self._vocabulary is None:
+            return None
+        vocabulary = self._vocabulary
+        return tuple(token for token in analyzed_sample if token in vocabulary)
 
     def attribute(self, sample: str) -> List[dict]:
         """Attribute given sample to rules of which the attributor holds rule models.
@@ -141,20 +411,113 @@ class RuleAttributor:
         attributions: List[dict]
             List of rule attributions, containing rule model names and confidence values.
         """
-        conf_values = self._calculate_rule_confidence_values(sample)
+        return self.attribute_batch([sample])[0]
 
-        return self._get_rules_with_highest_confidence_values(conf_values)
+    def attribute_batch(self, samples: List[str]) -> List[List[dict]]:
+        """Attribute given samples to rules of which the attributor holds rule models.
+        Each rule model evaluates the whole batch of samples at once.
 
-    def _calculate_rule_confidence_values(self, cmdline: str) -> List[dict]:
-        conf_values = []
+        Parameters
+        ----------
+        samples: List[str]
+            Malicious samples to attribute.
+
+        Returns
+        -------
+        attributions: List[List[dict]]
+            Rule attributions for each sample, containing rule model names and confidence values.
+        """
+        if not samples:
+            return []
+        if self._analysis_params is None:
+            rule_confidence_values = (
+                rule_model.detect_batch(samples) for rule_model in self._rule_models.values()
+            )
+            return self._get_attributions(rule_confidence_values, len(samples))
 
-        for name, rule_model in self._rule_models.items():
-            rule_confidence_value = rule_model.detect(cmdline)
-            conf_values.append({"rule": name, "confidence": round(rule_confidence_value, 3)})
+        analyzer = next(iter(self._rule_models.values())).analyze
+        return self.attribute_analyzed([analyzer(sample) for sample in samples])
 
-        return conf_values
+    def attribute_analyzed(self, analyzed_samples: List[List[str]]) -> List[List[dict]]:
+        """Attribute given already analyzed samples to rules of which the attributor holds
+        rule models. Requires all rule models to share the same analysis parameters.
 
-    def _get_rules_with_highest_confidence_values(self, conf_values: List[dict]) -> List[dict]:
-        conf_values.sort(key=lambda item: item["confidence"], reverse=True)
+        Parameters
+        ----------
+        analyzed_samples: List[List[str]]
+            Token lists of the malicious samples to attribute.
 
-        return conf_values[: self._num_rule_attributions]
+        Returns
+        -------
+        attributions: List[List[dict]]
+            Rule attributions for each sample, containing rule model names and confidence values.
+        """
+        if not analyzed_samples:
+            return []
+        if self._packed_weights is not None:
+            conf_values = self._calculate_packed_confidence_values(analyzed_samples)
+            return [
+                self._get_rules_with_highest_confidence_values(values) for values in conf_values
+            ]
+
+        rule_confidence_values = (
+            rule_model.detect_analyzed(analyzed_samples)
+            for rule_model in self._rule_models.values()
+        )
+        return self._get_attributions(rule_confidence_values, len(analyzed_samples))
+
+    def _calculate_packed_confidence_values(self, analyzed_samples: List[List[str]]) -> np.ndarray:
+        vocabulary = self._vocabulary
+        indices = []
+        indptr = [0]
+        for analyzed_sample in analyzed_samples:
+            indices.extend(vocabulary[token] for token in analyzed_sample if token in vocabulary)
+            indptr.append(len(indices))
+        term_counts = csr_matrix(
+            (np.ones(len(indices)), indices, indptr),
+            shape=(len(analyzed_samples), len(vocabulary)),
+        )
+        term_counts.sum_duplicates()
+
+        weights, squared_idf, intercepts = self._packed_weights
+        conf_values = term_counts @ weights
+        term_counts.data **= 2
+        norms = np.sqrt(term_counts @ squared_idf)
+        np.divide(conf_values, norms, out=conf_values, where=norms > 0)
+        conf_values[norms == 0] = 0.0
+        conf_values += intercepts
+
+        return conf_values.round(3)
+
+    def _get_attributions(
+        self, rule_confidence_values: Iterable[np.ndarray], num_samples: int
+    ) -> List[List[dict]]:
+        conf_values = self._calculate_rule_confidence_values(rule_confidence_values, num_samples)
+
+        return [self._get_rules_with_highest_confidence_values(values) for values in conf_values]
+
+    def _calculate_rule_confidence_values(
+        self, rule_confidence_values: Iterable[np.ndarray], num_samples: int
+    ) -> np.ndarray:
+        conf_values = np.empty((num_samples, len(self._rule_models)))
+
+        for index, confidence_values in enumerate(rule_confidence_values):
+            conf_values[:, index] = confidence_values
+
+        return conf_values.round(3)
+
+    def _get_rules_with_highest_confidence_values(self, conf_values: np.ndarray) -> List[dict]:
+        num_attributions = max(min(self._num_rule_attributions, len(conf_values)), 0)
+        if num_attributions == 0:
+            return []
+
+        candidates = np.arange(len(conf_values))
+        if num_attributions < len(conf_values):
+            threshold = np.partition(conf_values, -num_attributions)[-num_attributions]
+            candidates = np.flatnonzero(conf_values >= threshold)
+        ranked = candidates[np.argsort(-conf_values[candidates], kind="stable")]
+
+        return [
+            {"rule": self._rule_names[index], "confidence": conf_values[index].item()}
+            for index in ranked[:num_attributions]
+        ]
@@ -39,10 +39,10 @@ class FilterDummyCharacters(Preprocessor):
 
     def __init__(self):
         super().__init__()
-        self._re = r"[\"\^`’]"
+        self._re = re.compile(r"[\"\^`’]")
 
     def __call__(self, string: str):
-        return re.sub(self._re, "", string)
+        return self._re.sub("", string)
 
     @property
     def name(self):
@@ -90,16 +90,46 @@ class AnyWordCharacter(Tokenizer):
 
     def __init__(self):
         super().__init__()
-        self._re = r"(\w+)"
+        self._re = re.compile(r"\w+")
 
     def __call__(self, string: str):
-        return re.findall(self._re, string)
+        return self._re.findall(string)
 
     @property
     def name(self):
         return "any_word_char"
 
 
+class FilteredAnyWordCharacter(Tokenizer):
+    """FilteredAnyWordCharacter splits strings like AnyWordCharacter, but skips all tokens
+    that would be removed by the NumericValues and Strings token filters. Tokens are
+    matched and filtered by a single regular expression instead of filtering the token
+    list afterwards."""
+
+    def __init__(self, max_num_values_length: int, max_str_length: int):
+        """Init tokenizer.
+
+        Parameters
+        ----------
+        max_num_values_length: int
+            Maximum length of (hex-)numerical values which should not be filtered.
+        max_str_length: int
+            Maximum length of tokens which should not be filtered.
+        """
+        super().__init__()
+        self._re = re.compile(
+            rf"(?<!\w)(?!(?:0x)?[0-9a-f]{{{max_num_values_length + 1},}}(?!\w))"
+            rf"\w{{1,{max_str_length}}}(?!\w)"
+        )
+
+    def __call__(self, string: str):
+        return self._re.findall(string)
+
+    @property
+    def name(self):
+        return "filtered_any_word_char"
+
+
 class CommaSeparation(Tokenizer):
     """CommaSeparation-Tokenizer to split string on comma(,)-symbols."""
 
@@ -149,10 +179,10 @@ class NumericValues(TokenFilter):
             Maximum length of (hex-)numerical values which should not be filtered.
         """
         super().__init__()
-        self._re = rf"^(?:0x)?[0-9a-f]{{{length + 1},}}$"
+        self._re = re.compile(rf"^(?:0x)?[0-9a-f]{{{length + 1},}}$")
 
     def __call__(self, token_list):
-        tokens = [token for token in token_list if not re.match(self._re, token)]
+        tokens = [token for token in token_list if not self._re.match(token)]
 
         return tokens
 
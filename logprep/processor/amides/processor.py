@@ -42,19 +42,37 @@ misuse detector.
 Rule attribution is performed by the :code:`RuleAttributor` class. The :code:`num_rule_attributions`
 configuration parameter determines the number of rule attributions returned by the attributor.
 Models and vectorizer for rule attribution and feature extraction are held by :code:`RuleAttributor`
-instances.
+instances. Weights of linear rule models are packed into matrices over the union of their
+vocabularies, so that all rule models are evaluated at once.
 
 In order to speed up the detection and attribution process, the :code:`Amides` processor makes use
-of a LRU cache that keeps track of incoming command line samples. In case of a previously seen
+of a cache that keeps track of incoming command line samples. In case of a previously seen
 command line, classification and attribution results can be retrieved from the cache in a shorter
-amount of time. The :code:`max_cache_entries` configuration parameter determines the maximum number
-of elements of the internal cache.
+amount of time. Cache entries are identified by the 64 bit xxHash digest of the normalized command
+line. An additional cache identifies results by the digest of the raw command line, so that
+repeated command lines can be resolved without being normalized again. The
+:code:`max_cache_entries` configuration parameter determines the maximum number of elements of both
+caches together, each of them holding up to half of the entries. If a cache is full, its oldest
+entries are evicted first. Rule attributions are cached separately by the tokens of a command line
+that are known to any of the rule models, so that malicious command lines differing only in
+unknown tokens are attributed once. This cache holds up to a quarter of :code:`max_cache_entries`.
+
+Command lines extracted from an event are not evaluated rule by rule. Instead, they are collected
+while the rules are applied and evaluated together once the event has been processed. Misuse
+detection and rule attribution are then performed in one batch for all command lines that could not
+be resolved from the cache.
 
 Models used by the `MisuseDetector` and `RuleAttributor` are currently generated by `scikit-learn`.
 Each trained model needs to be packed into a dictionary together with its corresponding feature
 extractor and scaler. Dictionaries are then pickled and compressed (.zip). The URI or path of the
-compressed models file is given by the :code:`models_path` configuration parameter. An example of a
-configuration of the :code:`Amides` processor is given below:
+compressed models file is given by the :code:`models_path` configuration parameter. On first use,
+the models are unpacked once into a directory of the current user in the temporary directory of the
+system, identified by the SHA-256 digest of the compressed models file. Models unpacked from other
+files before are removed from there. All processes then load the unpacked models memory mapped, so
+that the model arrays are shared between them instead of being decompressed and copied by every
+process. If this directory is not exclusively accessible by the current user, each
+process unpacks the models on its own. An example of a configuration of the :code:`Amides`
+processor is given below:
 
 Processor Configuration
 ^^^^^^^^^^^^^^^^^^^^^^^
@@ -73,7 +91,8 @@ Processor Configuration
 
 To keep track of the components performance, the :code:`Amides` processor tracks several processor
 metrics. This includes the mean misuse detection time, the mean rule attribution time, and several
-cache-related metrics like the number of hits and misses and the current cache load.
+cache-related metrics like the number of hits and misses and the current cache load. Detection and
+attribution times are measured once per batch and reported as mean time per command line.
 
 .. autoclass:: logprep.processor.amides.processor.Amides.Config
    :members:
@@ -84,27 +103,66 @@ cache-related metrics like the number of hits and misses and the current cache l
 .. automodule:: logprep.processor.amides.rule
 """
 
+import hashlib
 import logging
-from functools import cached_property, lru_cache
+import mmap
+import os
+import pickle
+import shutil
+import stat
+import tempfile
+import time
+from collections import deque
+from functools import cached_property
 from multiprocessing import current_process
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 from zipfile import ZipFile
 
 import joblib
+import numpy as np
 from attr import define, field, validators
+from filelock import FileLock, Timeout
+from xxhash import xxh3_64_intdigest
 
-from logprep.abc.processor import Processor
-from logprep.metrics.metrics import CounterMetric, GaugeMetric, HistogramMetric, Metric
+from logprep.abc.processor import Processor, ProcessorResult
+from logprep.metrics.metrics import CounterMetric, GaugeMetric, HistogramMetric
 from logprep.processor.amides.detection import MisuseDetector, RuleAttributor
 from logprep.processor.amides.normalize import CommandLineNormalizer
 from logprep.processor.amides.rule import AmidesRule
+from logprep.processor.base.exceptions import FieldExistsWarning
 from logprep.processor.field_manager.processor import FieldManager
 from logprep.util.getter import GetterFactory
 from logprep.util.helper import get_dotted_field_value
 
 logger = logging.getLogger("Amides")
 
+MODEL_BUFFER_ALIGNMENT = 64
+MODEL_COPY_BUFFER_SIZE = 1 << 20
+UNPACKED_MODELS_FORMAT_VERSION = 1
+
+
+@define(frozen=True)
+class AmidesResult:
+    """Detection and attribution result of a command line as held by the cache of the
+    :code:`Amides` processor."""
+
+    confidence: float
+    """Confidence value of the misuse detector."""
+    attributions: Optional[Tuple[Tuple[str, float], ...]] = None
+    """Attributed rule names and confidence values, if the command line is malicious."""
+
+    def as_dict(self) -> dict:
+        """Return the result as new dict to be written into events."""
+        if self.attributions is None:
+            return {"confidence": self.confidence}
+        return {
+            "confidence": self.confidence,
+            "attributions": [
+                {"rule": rule, "confidence": confidence} for rule, confidence in self.attributions
+            ],
+        }
+
 
 class Amides(FieldManager):
     """Proof-of-concept implementation of the Adaptive Misuse Detection System (AMIDES)."""
@@ -114,7 +172,10 @@ class Amides(FieldManager):
         """Amides processor configuration class."""
 
         max_cache_entries: int = field(default=1048576, validator=validators.instance_of(int))
-        """Maximum number of cached command lines  and their rule attribution results."""
+        """Maximum number of cached results. Half of the entries are reserved for results
+        identified by the raw command line and the other half for results identified by the
+        normalized command line. Rule attributions are cached separately in up to a quarter
+        of this number of additional entries."""
         decision_threshold: float = field(validator=validators.instance_of(float))
         """Specifies the decision threshold of the misuse detector to adjust it's overall
         classification performance."""
@@ -171,6 +232,13 @@ class Amides(FieldManager):
             )
         )
         """Relative cache load."""
+        num_raw_cache_entries: GaugeMetric = field(
+            factory=lambda: GaugeMetric(
+                description="Absolute number of current entries of the raw command line cache.",
+                name="amides_num_raw_cache_entries",
+            )
+        )
+        """Absolute number of current entries of the raw command line cache."""
         mean_misuse_detection_time: HistogramMetric = field(
             factory=lambda: HistogramMetric(
                 description="Mean processing time of command lines classified by the misuse detector.",
@@ -189,20 +257,60 @@ class Amides(FieldManager):
     __slots__ = (
         "_misuse_detector",
         "_rule_attributor",
+        "_shared_analysis",
+        "_pending",
+        "_cache",
+        "_cache_order",
+        "_raw_cache",
+        "_raw_cache_order",
+        "_attribution_cache",
+        "_attribution_cache_order",
+        "_cache_hits",
+        "_cache_misses",
     )
 
     _misuse_detector: MisuseDetector
     _rule_attributor: RuleAttributor
+    _shared_analysis: bool
+    _pending: List[Tuple[dict, AmidesRule, int, Optional[int], Optional[str]]]
+    _cache: Dict[int, AmidesResult]
+    _cache_order: deque
+    _raw_cache: Dict[int, AmidesResult]
+    _raw_cache_order: deque
+    _attribution_cache: Dict[int, Tuple[Tuple[str, float], ...]]
+    _attribution_cache_order: deque
+    _cache_hits: int
+    _cache_misses: int
 
     rule_class = AmidesRule
 
+    def __init__(self, name: str, configuration: FieldManager.Config):
+        super().__init__(name, configuration)
+        self._pending = []
+        self._cache = {}
+        self._cache_order = deque()
+        self._raw_cache = {}
+        self._raw_cache_order = deque()
+        self._attribution_cache = {}
+        self._attribution_cache_order = deque()
+        self._cache_hits = 0
+        self._cache_misses = 0
+
     @cached_property
     def _normalizer(self):
         return CommandLineNormalizer(max_num_values_length=3, max_str_length=30)
 
-    @cached_property
-    def _evaluate_cmdline_cached(self):
-        return lru_cache(maxsize=self._config.max_cache_entries)(self._evaluate_cmdline)
+    @property
+    def _max_raw_cache_entries(self) -> int:
+        return self._config.max_cache_entries // 2
+
+    @property
+    def _max_normalized_cache_entries(self) -> int:
+        return self._config.max_cache_entries - self._max_raw_cache_entries
+
+    @property
+    def _max_attribution_cache_entries(self) -> int:
+        return self._config.max_cache_entries // 4
 
     def setup(self):
         super().setup()
@@ -213,6 +321,9 @@ class Amides(FieldManager):
             models["multi"],
             self._config.num_rule_attributions,
         )
+        self._shared_analysis = (
+            self._misuse_detector.analysis_params == self._rule_attributor.analysis_params
+        )
 
     def _load_and_unpack_models(self):
         models_path = self._config.models_path
@@ -224,12 +335,125 @@ class Amides(FieldManager):
             logger.debug("Finished getting AMIDES models archive...")
             models_path = str(models_archive.absolute())
 
+        unpacked_models_dir = self._get_unpacked_models_dir()
+        if unpacked_models_dir is None:
+            return self._unpack_models(models_path)
+
+        unpacked_models_path = unpacked_models_dir / (
+            f"amides-v{UNPACKED_MODELS_FORMAT_VERSION}-{self._get_models_digest(models_path)}"
+        )
+        with FileLock(f"{unpacked_models_path}.lock"):
+            if not unpacked_models_path.with_suffix(".pkl").exists():
+                self._remove_stale_unpacked_models(unpacked_models_path)
+                self._dump_unpacked_models(self._unpack_models(models_path), unpacked_models_path)
+            return self._load_unpacked_models(unpacked_models_path)
+
+    @staticmethod
+    def _get_unpacked_models_dir() -> Optional[Path]:
+        """Returns the directory of the current user for unpacked models in the temporary
+        directory of the system. Returns None if the directory can not be created or is not
+        exclusively accessible by the current user, since unpacked models are unpickled from
+        it."""
+        path = Path(tempfile.gettempdir()) / f"logprep-{os.getuid()}"
+        try:
+            os.mkdir(path, mode=0o700)
+        except FileExistsError:
+            pass
+        except OSError as error:
+            logger.warning("Could not create directory for unpacked AMIDES models: %s", error)
+            return None
+        path_stat = os.lstat(path)
+        if (
+            not stat.S_ISDIR(path_stat.st_mode)
+            or path_stat.st_uid != os.getuid()
+            or stat.S_IMODE(path_stat.st_mode) & 0o077
+        ):
+            logger.warning(
+                "Directory %s is not exclusively owned by the current user, "
+                "AMIDES models are unpacked without being shared",
+                path,
+            )
+            return None
+        return path
+
+    @staticmethod
+    def _get_models_digest(models_path: str) -> str:
+        """Returns the digest of the compressed models archive, which identifies the unpacked
+        models without having to decompress them."""
+        digest = hashlib.sha256()
+        with open(models_path, "rb") as models_archive:
+            while chunk := models_archive.read(MODEL_COPY_BUFFER_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _remove_stale_unpacked_models(path: Path):
+        """Removes models unpacked from other archives, unless they are being set up by another
+        processor at the same time. Mapped buffers of processors that are already set up remain
+        valid after removal. The empty lock files are kept, as they may still be in use."""
+        for stale_pickle_path in path.parent.glob("amides-v*.pkl"):
+            stale_path = stale_pickle_path.with_suffix("")
+            if stale_path == path:
+                continue
+            try:
+                with FileLock(f"{stale_path}.lock", timeout=0):
+                    stale_pickle_path.unlink(missing_ok=True)
+                    stale_path.with_suffix(".buffers").unlink(missing_ok=True)
+            except Timeout:
+                continue
+
+    @staticmethod
+    def _unpack_models(models_path: str) -> dict:
+        logger.debug("Unpacking AMIDES models...")
         with ZipFile(models_path, mode="r") as zip_file:
-            with zip_file.open("model", mode="r") as models_file:
+            with tempfile.TemporaryFile() as models_file:
+                with zip_file.open("model", mode="r") as compressed_models_file:
+                    shutil.copyfileobj(
+                        compressed_models_file, models_file, length=MODEL_COPY_BUFFER_SIZE
+                    )
+                models_file.seek(0)
                 models = joblib.load(models_file)
-
+        logger.debug("Finished unpacking AMIDES models...")
         return models
 
+    @staticmethod
+    def _dump_unpacked_models(models: dict, path: Path):
+        """Pickles models with all contiguous array buffers stored out-of-band in a separate
+        file, which allows to map all arrays from one shared memory mapping."""
+        buffers = []
+        payload = pickle.dumps(models, protocol=5, buffer_callback=buffers.append)
+        buffer_spans = []
+        buffers_tmp_path = path.with_suffix(".buffers.tmp")
+        with open(buffers_tmp_path, "wb") as buffers_file:
+            for buffer in buffers:
+                offset = -buffers_file.tell() % MODEL_BUFFER_ALIGNMENT
+                buffers_file.write(b"\0" * offset)
+                raw_buffer = buffer.raw()
+                buffer_spans.append((buffers_file.tell(), raw_buffer.nbytes))
+                buffers_file.write(raw_buffer)
+        pickle_tmp_path = path.with_suffix(".pkl.tmp")
+        with open(pickle_tmp_path, "wb") as pickle_file:
+            pickle.dump((buffer_spans, payload), pickle_file, protocol=5)
+        os.replace(buffers_tmp_path, path.with_suffix(".buffers"))
+        os.replace(pickle_tmp_path, path.with_suffix(".pkl"))
+
+    @staticmethod
+    def _load_unpacked_models(path: Path) -> dict:
+        with open(path.with_suffix(".pkl"), "rb") as pickle_file:
+            buffer_spans, payload = pickle.load(pickle_file)
+        with open(path.with_suffix(".buffers"), "rb") as buffers_file:
+            if not buffer_spans:
+                return pickle.loads(payload)
+            buffers = memoryview(mmap.mmap(buffers_file.fileno(), 0, access=mmap.ACCESS_COPY))
+        return pickle.loads(
+            payload, buffers=[buffers[offset : offset + size] for offset, size in buffer_spans]
+        )
+
+    def process(self, event: dict) -> ProcessorResult:
+        result = super().process(event)
+        self._flush_batch()
+        return result
+
     def _apply_rules(self, event: dict, rule: AmidesRule):
         cmdline = get_dotted_field_value(event, rule.source_fields[0])
         if self._handle_missing_fields(event, rule, rule.source_fields, [cmdline]):
@@ -237,37 +461,224 @@ class Amides(FieldManager):
 
         self.metrics.total_cmdlines += 1
 
+        raw_key = xxh3_64_intdigest(cmdline.encode("utf-8", "surrogatepass"))
+        if raw_key in self._raw_cache:
+            self._pending.append((event, rule, raw_key, None, None))
+            return
+
         normalized = self._normalizer.normalize(cmdline)
         if not normalized:
             return
 
-        result = self._evaluate_cmdline_cached(normalized)
-        self._update_cache_metrics()
+        key = xxh3_64_intdigest(normalized.encode("utf-8", "surrogatepass"))
+        self._pending.append((event, rule, raw_key, key, normalized))
 
-        self._write_target_field(event=event, rule=rule, result=result)
+    def _flush_batch(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            results = self._get_pending_results(pending)
+        except Exception as error:  # pylint: disable=broad-except
+            for event, rule, *_ in pending:
+                if event:
+                    self._handle_rule_error(event, rule, error)
+            return
 
-    def _evaluate_cmdline(self, cmdline: str):
-        result = {}
+        for (event, rule, *_), result in zip(pending, results):
+            if not event:
+                continue
+            try:
+                self._write_target_field(event=event, rule=rule, result=result.as_dict())
+            except Exception as error:  # pylint: disable=broad-except
+                self._handle_rule_error(event, rule, error)
+
+    def _get_pending_results(
+        self, pending: List[Tuple[dict, AmidesRule, int, Optional[int], Optional[str]]]
+    ) -> List[AmidesResult]:
+        """Returns the results of all pending command lines in order. Command lines pending
+        without a key were found in the raw command line cache and are resolved from there
+        before it is updated, all others are resolved from the cache or evaluated."""
+        raw_hits = {
+            raw_key: self._raw_cache[raw_key] for _, _, raw_key, key, _ in pending if key is None
+        }
+        keys = [key for _, _, _, key, _ in pending if key is not None]
+        cmdlines = [cmdline for _, _, _, key, cmdline in pending if key is not None]
+        results, misses = self._get_cached_results(keys, cmdlines)
+        num_hits = len(pending) - len(misses)
+        if num_hits:
+            self._cache_hits += num_hits
+            self.metrics.cached_results += self._cache_hits
+        if misses:
+            new_results = self._evaluate_cmdlines(misses)
+            self._cache_misses += len(misses)
+            self.metrics.new_results += self._cache_misses
+            self._add_to_cache(
+                self._cache, self._cache_order, new_results, self._max_normalized_cache_entries
+            )
+            results.update(new_results)
+            self._update_cache_metrics()
+        if keys:
+            raw_results = {
+                raw_key: results[key] for _, _, raw_key, key, _ in pending if key is not None
+            }
+            self._add_to_cache(
+                self._raw_cache, self._raw_cache_order, raw_results, self._max_raw_cache_entries
+            )
+            self.metrics.num_raw_cache_entries += len(self._raw_cache)
 
-        malicious, result["confidence"] = self._perform_misuse_detection(cmdline)
-        if malicious:
-            result["attributions"] = self._calculate_rule_attributions(cmdline)
+        return [
+            raw_hits[raw_key] if key is None else results[key] for _, _, raw_key, key, _ in pending
+        ]
 
-        return result
+    def _write_target_field(self, event: dict, rule: AmidesRule, result: dict) -> None:
+        """Writes the result into the target field of the rule, walking the parent fields by
+        the pre-split target field path of the rule instead of parsing it for every event."""
+        if rule.extend_target_list:
+            super()._write_target_field(event, rule, result)
+            return
+        parent_keys, target_key = rule.target_field_path
+        target_parent = event
+        for key in parent_keys:
+            value = target_parent.get(key)
+            if not isinstance(value, dict):
+                if key in target_parent and not rule.overwrite_target:
+                    raise FieldExistsWarning(rule, event, [rule.target_field])
+                value = target_parent[key] = {}
+            target_parent = value
+        if not rule.overwrite_target and target_parent.get(target_key) is not None:
+            raise FieldExistsWarning(rule, event, [rule.target_field])
+        target_parent[target_key] = result
+
+    def _get_cached_results(
+        self, keys: List[int], cmdlines: List[str]
+    ) -> Tuple[Dict[int, AmidesResult], Dict[int, str]]:
+        results = {}
+        misses = {}
+        for key, cmdline in zip(keys, cmdlines):
+            if key in results or key in misses:
+                continue
+            result = self._cache.get(key)
+            if result is None:
+                misses[key] = cmdline
+            else:
+                results[key] = result
+
+        return results, misses
+
+    @staticmethod
+    def _add_to_cache(
+        cache: Dict[int, AmidesResult],
+        cache_order: deque,
+        results: Dict[int, AmidesResult],
+        max_entries: int,
+    ):
+        cache.update(results)
+        cache_order.extend(results.keys())
+        while len(cache) > max_entries:
+            del cache[cache_order.popleft()]
 
-    @Metric.measure_time(metric_name="mean_misuse_detection_time")
-    def _perform_misuse_detection(self, cmdline: str) -> Tuple[bool, float]:
-        result = self._misuse_detector.detect(cmdline)
+    def _update_cache_metrics(self):
+        num_cache_entries = len(self._cache)
+        self.metrics.num_cache_entries += num_cache_entries
+        self.metrics.cache_load += num_cache_entries / self._max_normalized_cache_entries
+
+    def _evaluate_cmdlines(self, cmdlines: Dict[int, str]) -> Dict[int, AmidesResult]:
+        keys = list(cmdlines.keys())
+        samples = list(cmdlines.values())
+        analyzed_samples = [self._misuse_detector.analyze(sample) for sample in samples]
+        malicious, confidence_values = self._perform_misuse_detection(analyzed_samples)
+        confidence_values = confidence_values.tolist()
+        results = {
+            key: AmidesResult(confidence_value)
+            for key, confidence_value in zip(keys, confidence_values)
+        }
+
+        malicious_indices = np.flatnonzero(malicious).tolist()
+        if not malicious_indices:
+            return results
+
+        attributions = self._get_rule_attributions(
+            [samples[index] for index in malicious_indices],
+            [analyzed_samples[index] for index in malicious_indices],
+        )
+        for index, rule_attributions in zip(malicious_indices, attributions):
+            results[keys[index]] = AmidesResult(confidence_values[index], rule_attributions)
+
+        return results
+
+    def _perform_misuse_detection(
+        self, analyzed_cmdlines: List[List[str]]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        begin = time.perf_counter()
+        result = self._misuse_detector.detect_analyzed(analyzed_cmdlines)
+        self.metrics.mean_misuse_detection_time += (time.perf_counter() - begin) / len(
+            analyzed_cmdlines
+        )
         return result
 
-    @Metric.measure_time(metric_name="mean_rule_attribution_time")
-    def _calculate_rule_attributions(self, cmdline: str) -> List[dict]:
-        attributions = self._rule_attributor.attribute(cmdline)
-        return attributions
-
-    def _update_cache_metrics(self):
-        cache_info = self._evaluate_cmdline_cached.cache_info()
-        self.metrics.new_results += cache_info.misses
-        self.metrics.cached_results += cache_info.hits
-        self.metrics.num_cache_entries += cache_info.currsize
-        self.metrics.cache_load += cache_info.currsize / cache_info.maxsize
+    def _get_rule_attributions(
+        self, cmdlines: List[str], analyzed_cmdlines: List[List[str]]
+    ) -> List[Tuple[Tuple[str, float], ...]]:
+        """Returns rule attributions of the given malicious command lines. Attributions are
+        cached by the tokens that are known to any rule model, since all other tokens do not
+        influence the attribution."""
+        if not self._shared_analysis:
+            return self._calculate_rule_attributions(cmdlines, analyzed_cmdlines)
+        relevant_tokens = [
+            self._rule_attributor.get_relevant_tokens(analyzed_cmdline)
+            for analyzed_cmdline in analyzed_cmdlines
+        ]
+        if relevant_tokens[0] is None:
+            return self._calculate_rule_attributions(cmdlines, analyzed_cmdlines)
+
+        attribution_keys = [
+            xxh3_64_intdigest(",".join(tokens).encode("utf-8", "surrogatepass"))
+            for tokens in relevant_tokens
+        ]
+        attributions = {}
+        misses = {}
+        for key, cmdline, analyzed_cmdline in zip(attribution_keys, cmdlines, analyzed_cmdlines):
+            if key in attributions or key in misses:
+                continue
+            rule_attributions = self._attribution_cache.get(key)
+            if rule_attributions is None:
+                misses[key] = (cmdline, analyzed_cmdline)
+            else:
+                attributions[key] = rule_attributions
+        if misses:
+            new_attributions = dict(
+                zip(
+                    misses.keys(),
+                    self._calculate_rule_attributions(
+                        [cmdline for cmdline, _ in misses.values()],
+                        [analyzed_cmdline for _, analyzed_cmdline in misses.values()],
+                    ),
+                )
+            )
+            self._add_to_cache(
+                self._attribution_cache,
+                self._attribution_cache_order,
+                new_attributions,
+                self._max_attribution_cache_entries,
+            )
+            attributions.update(new_attributions)
+
+        return [attributions[key] for key in attribution_keys]
+
+    def _calculate_rule_attributions(
+        self, cmdlines: List[str], analyzed_cmdlines: List[List[str]]
+    ) -> List[Tuple[Tuple[str, float], ...]]:
+        begin = time.perf_counter()
+        if self._shared_analysis:
+            attributions = self._rule_attributor.attribute_analyzed(analyzed_cmdlines)
+        else:
+            attributions = self._rule_attributor.attribute_batch(cmdlines)
+        self.metrics.mean_rule_attribution_time += (time.perf_counter() - begin) / len(cmdlines)
+        return [
+            tuple(
+                (attribution["rule"], attribution["confidence"])
+                for attribution in rule_attributions
+            )
+            for rule_attributions in attributions
+        ]
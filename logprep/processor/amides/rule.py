@@ -27,10 +27,14 @@ The following example shows a complete rule:
    :no-undoc-members:
 """
 
+from functools import cached_property
+from typing import Tuple
+
 from attrs import define, field, validators
 from ruamel.yaml import YAML
 
 from logprep.processor.field_manager.rule import FieldManagerRule
+from logprep.util.helper import get_dotted_field_list
 
 yaml = YAML(typ="safe", pure=True)
 
@@ -58,3 +62,9 @@ class AmidesRule(FieldManagerRule):
         ignore_missing_fields: bool = field(
             init=False, repr=False, eq=False, default=False, validator=validators.instance_of(bool)
         )
+
+    @cached_property
+    def target_field_path(self) -> Tuple[Tuple[str, ...], str]:
+        """Returns the keys of the parent fields of the target field and the target key"""
+        *parent_keys, target_key = get_dotted_field_list(self.target_field)
+        return tuple(parent_keys), target_key
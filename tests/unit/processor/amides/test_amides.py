@@ -1,18 +1,33 @@
 # pylint: disable=missing-docstring
 # pylint: disable=protected-access
 import hashlib
+import os
 import re
+import stat
+import tempfile
 from copy import deepcopy
 from multiprocessing import current_process
 from pathlib import Path
+from unittest import mock
+from zipfile import ZipFile
 
 import pytest
 import responses
+from filelock import FileLock
 
 from logprep.factory import Factory
+from logprep.processor.amides.detection import RuleAttributor
+from logprep.processor.amides.processor import AmidesResult
+from logprep.processor.base.exceptions import ProcessingCriticalError
 from tests.unit.processor.base import BaseProcessorTestCase
 
 
+@pytest.fixture(name="tempdir", autouse=True)
+def fixture_tempdir(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    return tmp_path
+
+
 class TestAmides(BaseProcessorTestCase):
     CONFIG = {
         "type": "amides",
@@ -30,6 +45,7 @@ class TestAmides(BaseProcessorTestCase):
         "logprep_amides_cached_results",
         "logprep_amides_num_cache_entries",
         "logprep_amides_cache_load",
+        "logprep_amides_num_raw_cache_entries",
         "logprep_amides_mean_misuse_detection_time",
         "logprep_amides_mean_rule_attribution_time",
     ]
@@ -39,6 +55,9 @@ class TestAmides(BaseProcessorTestCase):
         self.object.metrics.new_results = 0
         self.object.metrics.num_cache_entries = 0
         self.object.metrics.cache_load = 0.0
+        self.object.metrics.num_raw_cache_entries = 0
+        self.object.metrics.mean_misuse_detection_time = 0.0
+        self.object.metrics.mean_rule_attribution_time = 0.0
         self.object.setup()
         document = {
             "winlog": {
@@ -59,13 +78,17 @@ class TestAmides(BaseProcessorTestCase):
         assert self.object.metrics.total_cmdlines == 1
         assert self.object.metrics.new_results == 1
         assert self.object.metrics.num_cache_entries == 1
-        assert self.object.metrics.cache_load == 0.2
+        assert self.object.metrics.cache_load == 1 / 3
+        assert self.object.metrics.num_raw_cache_entries == 1
+        assert self.object.metrics.mean_misuse_detection_time > 0.0
+        assert self.object.metrics.mean_rule_attribution_time > 0.0
 
     def test_process_event_benign_process_command_line(self):
         self.object.metrics.total_cmdlines = 0
         self.object.metrics.new_results = 0
         self.object.metrics.num_cache_entries = 0
         self.object.metrics.cache_load = 0.0
+        self.object.metrics.num_raw_cache_entries = 0
         self.object.setup()
         document = {
             "winlog": {
@@ -83,7 +106,8 @@ class TestAmides(BaseProcessorTestCase):
         assert self.object.metrics.total_cmdlines == 1
         assert self.object.metrics.new_results == 1
         assert self.object.metrics.num_cache_entries == 1
-        assert self.object.metrics.cache_load == 0.2
+        assert self.object.metrics.cache_load == 1 / 3
+        assert self.object.metrics.num_raw_cache_entries == 1
 
     no_pc_events = [
         {"winlog": {"event_id": 6005, "provider_name": "Microsoft-Windows-Sysmon"}},
@@ -98,6 +122,7 @@ class TestAmides(BaseProcessorTestCase):
         self.object.metrics.new_results = 0
         self.object.metrics.num_cache_entries = 0
         self.object.metrics.cache_load = 0.0
+        self.object.metrics.num_raw_cache_entries = 0
         self.object.setup()
 
         self.object.process(document)
@@ -112,6 +137,7 @@ class TestAmides(BaseProcessorTestCase):
         self.object.metrics.new_results = 0
         self.object.metrics.num_cache_entries = 0
         self.object.metrics.cache_load = 0.0
+        self.object.metrics.num_raw_cache_entries = 0
         self.object.setup()
         document = {
             "winlog": {"event_id": 1, "provider_name": "Microsoft-Windows-Sysmon"},
@@ -131,6 +157,7 @@ class TestAmides(BaseProcessorTestCase):
         self.object.metrics.cached_results = 0
         self.object.metrics.num_cache_entries = 0
         self.object.metrics.cache_load = 0.0
+        self.object.metrics.num_raw_cache_entries = 0
         self.object.setup()
         document = {
             "winlog": {
@@ -146,15 +173,127 @@ class TestAmides(BaseProcessorTestCase):
 
         assert other_document.get("amides") == document.get("amides")
         assert self.object.metrics.total_cmdlines == 2
-        # we mock the metrics with integer operations, so the assertions
-        # are a little bit weird:
-        # we assert for 2 because we add two times the same cache result
-        # the underlying metric implementation sets the values instead of adding
-        # them
-        assert self.object.metrics.new_results == 2
-        assert self.object.metrics.num_cache_entries == 2
-        assert self.object.metrics.cache_load == 0.4
-        # end strange mock
+        # gauges are only updated if their value changes, the cache hit
+        # of the second event therefore leaves the miss related gauges untouched
+        assert self.object.metrics.new_results == 1
+        assert self.object.metrics.num_cache_entries == 1
+        assert self.object.metrics.cache_load == 1 / 3
+        assert self.object.metrics.num_raw_cache_entries == 1
+        assert self.object.metrics.cached_results == 1
+
+    def test_cache_evicts_oldest_entries(self):
+        self.object.setup()
+        cmdlines = [f"cmd.exe /c taskkill.exe /im proc{index}.exe" for index in range(6)]
+        for cmdline in cmdlines:
+            document = {
+                "winlog": {
+                    "event_id": 1,
+                    "provider_name": "Microsoft-Windows-Sysmon",
+                    "event_data": {"CommandLine": cmdline},
+                }
+            }
+            self.object.process(document)
+
+        assert len(self.object._cache) == 3
+        assert len(self.object._raw_cache) == 2
+        assert list(self.object._cache) == list(self.object._cache_order)
+        assert list(self.object._raw_cache) == list(self.object._raw_cache_order)
+
+    def test_cached_results_are_not_shared_between_events(self):
+        self.object.setup()
+        document = {
+            "winlog": {
+                "event_id": 1,
+                "provider_name": "Microsoft-Windows-Sysmon",
+                "event_data": {"CommandLine": "cmd.exe /c taskkill.exe /im cmd.exe"},
+            }
+        }
+        other_document = deepcopy(document)
+
+        self.object.process(document)
+        expected = deepcopy(document["amides"])
+        document["amides"]["attributions"][0]["rule"] = "modified"
+        self.object.process(other_document)
+
+        assert other_document["amides"] == expected
+
+    def test_attributions_are_cached_by_known_tokens(self):
+        self.object.metrics.mean_rule_attribution_time = 0.0
+        self.object.setup()
+        documents = [
+            {
+                "winlog": {
+                    "event_id": 1,
+                    "provider_name": "Microsoft-Windows-Sysmon",
+                    "event_data": {"CommandLine": cmdline},
+                }
+            }
+            for cmdline in [
+                "cmd.exe /c taskkill.exe /im cmd.exe",
+                "cmd.exe /c taskkill.exe /im cmd.exe /unknowntokenxyz",
+            ]
+        ]
+
+        with mock.patch(
+            "logprep.processor.amides.detection.RuleAttributor.attribute_analyzed",
+            autospec=True,
+            side_effect=RuleAttributor.attribute_analyzed,
+        ) as mock_attribute:
+            for document in documents:
+                self.object.process(document)
+
+        mock_attribute.assert_called_once()
+        assert len(self.object._cache) == 2
+        assert len(self.object._attribution_cache) == 1
+        assert documents[0]["amides"]["attributions"] == documents[1]["amides"]["attributions"]
+
+    def test_repeated_cmdline_is_not_normalized_again(self):
+        self.object.metrics.new_results = 0
+        self.object.metrics.cached_results = 0
+        self.object.setup()
+        document = {
+            "winlog": {
+                "event_id": 1,
+                "provider_name": "Microsoft-Windows-Sysmon",
+                "event_data": {"CommandLine": "cmd.exe /c taskkill.exe /im cmd.exe"},
+            }
+        }
+        other_document = deepcopy(document)
+        self.object.process(document)
+
+        with mock.patch(
+            "logprep.processor.amides.normalize.CommandLineNormalizer.normalize"
+        ) as mock_normalize:
+            self.object.process(other_document)
+
+        mock_normalize.assert_not_called()
+        assert other_document.get("amides") == document.get("amides")
+        assert self.object.metrics.new_results == 1
+        assert self.object.metrics.cached_results == 1
+
+    def test_cmdline_variant_is_resolved_from_normalized_cache(self):
+        self.object.metrics.new_results = 0
+        self.object.metrics.cached_results = 0
+        self.object.setup()
+        document = {
+            "winlog": {
+                "event_id": 1,
+                "provider_name": "Microsoft-Windows-Sysmon",
+                "event_data": {"CommandLine": "cmd.exe /c taskkill.exe /im cmd.exe"},
+            }
+        }
+        other_document = deepcopy(document)
+        other_document["winlog"]["event_data"][
+            "CommandLine"
+        ] = 'CMD.exe /c "taskkill.exe" /im cmd.exe'
+
+        self.object.process(document)
+        self.object.process(other_document)
+
+        assert other_document.get("amides") == document.get("amides")
+        assert len(self.object._raw_cache) == 2
+        assert len(self.object._cache) == 1
+        assert self.object.metrics.new_results == 1
         assert self.object.metrics.cached_results == 1
 
     def test_process_event_raise_duplication_error(self):
@@ -175,6 +314,94 @@ class TestAmides(BaseProcessorTestCase):
         )
         assert re.match(".*FieldExistsWarning.*", str(result.warnings))
 
+    @pytest.mark.parametrize(
+        "overwrite_target, existing_detection, expected_detection",
+        [
+            (False, None, {"amides": {"confidence": 0.0}}),
+            (False, {"other": 1}, {"other": 1, "amides": {"confidence": 0.0}}),
+            (False, "not a dict", "not a dict"),
+            (True, "not a dict", {"amides": {"confidence": 0.0}}),
+            (False, {"amides": "existing"}, {"amides": "existing"}),
+            (True, {"amides": "existing"}, {"amides": {"confidence": 0.0}}),
+        ],
+    )
+    def test_writes_result_into_dotted_target_field(
+        self, overwrite_target, existing_detection, expected_detection
+    ):
+        rule = {
+            "filter": "process.command_line",
+            "amides": {
+                "source_fields": ["process.command_line"],
+                "target_field": "detection.amides",
+                "overwrite_target": overwrite_target,
+            },
+        }
+        self._load_specific_rule(rule)
+        self.object.setup()
+        document = {"process": {"command_line": "C:\\Windows\\system32\\svchost.exe -k DcomLaunch"}}
+        if existing_detection is not None:
+            document["detection"] = deepcopy(existing_detection)
+
+        with mock.patch.object(
+            self.object,
+            "_evaluate_cmdlines",
+            side_effect=lambda cmdlines: {key: AmidesResult(0.0) for key in cmdlines},
+        ):
+            result = self.object.process(document)
+
+        assert document["detection"] == expected_detection
+        assert bool(result.warnings) == (document["detection"] == existing_detection)
+
+    def test_write_error_is_turned_into_critical_error_independent_of_cache(self):
+        rule = {
+            "filter": "process.command_line",
+            "amides": {
+                "source_fields": ["process.command_line"],
+                "target_field": "amides",
+                "overwrite_target": True,
+                "extend_target_list": True,
+            },
+        }
+        self._load_specific_rule(rule)
+        self.object.setup()
+        for _ in range(2):
+            document = {"process": {"command_line": "cmd.exe /c taskkill.exe /im cmd.exe"}}
+
+            result = self.object.process(document)
+
+            assert len(result.errors) == 1
+            assert isinstance(result.errors[0], ProcessingCriticalError)
+            assert not document
+
+    def test_flush_skips_events_cleared_by_earlier_critical_error(self):
+        self.object.setup()
+        document = {"process": {"command_line": "cmd.exe /c taskkill.exe /im cmd.exe"}}
+        rule = self.object.rules[0]
+        self.object._apply_rules(document, rule)
+        assert self.object._pending
+        document.clear()
+
+        with mock.patch.object(self.object, "_write_target_field") as mock_write:
+            self.object._flush_batch()
+
+        mock_write.assert_not_called()
+        assert not document
+
+    def test_raw_cache_hit_is_written_on_flush(self):
+        self.object.setup()
+        document = {"process": {"command_line": "cmd.exe /c taskkill.exe /im cmd.exe"}}
+        other_document = deepcopy(document)
+        rule = self.object.rules[0]
+        self.object._apply_rules(document, rule)
+        self.object._flush_batch()
+        assert self.object._raw_cache
+
+        self.object._apply_rules(other_document, rule)
+        assert "amides" not in other_document
+        self.object._flush_batch()
+
+        assert other_document.get("amides") == document.get("amides")
+
     def test_setup_get_model_via_file_getter(self, tmp_path, monkeypatch):
         model_uri = "file://tests/testdata/unit/amides/model.zip"
         model_original = Path(self.CONFIG["models_path"])
@@ -216,3 +443,87 @@ class TestAmides(BaseProcessorTestCase):
             assert loaded_file.exists()
             loaded_checksum = hashlib.md5(loaded_file.read_bytes()).hexdigest()  # nosemgrep
             assert expected_checksum == loaded_checksum
+
+    def test_setup_unpacks_models_once(self, tmp_path):
+        self.object.setup()
+        unpacked_models_dir = tmp_path / f"logprep-{os.getuid()}"
+        assert stat.S_IMODE(unpacked_models_dir.stat().st_mode) == 0o700
+        assert len(list(unpacked_models_dir.glob("amides-v1-*.pkl"))) == 1
+        assert len(list(unpacked_models_dir.glob("amides-v1-*.buffers"))) == 1
+
+        other_processor = Factory.create({"amides": self.CONFIG})
+        with mock.patch("joblib.load", side_effect=AssertionError("models were unpacked again")):
+            other_processor.setup()
+        document = {
+            "winlog": {
+                "event_id": 1,
+                "provider_name": "Microsoft-Windows-Sysmon",
+                "event_data": {"CommandLine": "cmd.exe /c taskkill.exe /im cmd.exe"},
+            }
+        }
+        other_document = deepcopy(document)
+        self.object.process(document)
+        other_processor.process(other_document)
+        assert other_document.get("amides") == document.get("amides")
+
+    def test_setup_decompresses_models_at_most_once(self):
+        with mock.patch(
+            "logprep.processor.amides.processor.ZipFile.open",
+            autospec=True,
+            side_effect=ZipFile.open,
+        ) as mock_open:
+            self.object.setup()
+            assert mock_open.call_count == 1
+            Factory.create({"amides": self.CONFIG}).setup()
+            assert mock_open.call_count == 1
+
+    def test_setup_unpacks_models_without_sharing_from_untrusted_dir(self, tmp_path):
+        unpacked_models_dir = tmp_path / f"logprep-{os.getuid()}"
+        unpacked_models_dir.mkdir()
+        unpacked_models_dir.chmod(0o777)
+
+        with mock.patch("pickle.loads", side_effect=AssertionError("unpacked models were loaded")):
+            self.object.setup()
+
+        assert not list(unpacked_models_dir.iterdir())
+        document = {
+            "winlog": {
+                "event_id": 1,
+                "provider_name": "Microsoft-Windows-Sysmon",
+                "event_data": {"CommandLine": "cmd.exe /c taskkill.exe /im cmd.exe"},
+            }
+        }
+        self.object.process(document)
+        assert document.get("amides")
+
+    def test_setup_names_unpacked_models_by_digest(self, tmp_path):
+        self.object.setup()
+        unpacked_models_dir = tmp_path / f"logprep-{os.getuid()}"
+        digest = hashlib.sha256(Path(self.CONFIG["models_path"]).read_bytes()).hexdigest()
+
+        assert (unpacked_models_dir / f"amides-v1-{digest}.pkl").exists()
+        assert (unpacked_models_dir / f"amides-v1-{digest}.buffers").exists()
+
+    def test_setup_removes_stale_unpacked_models(self, tmp_path):
+        unpacked_models_dir = tmp_path / f"logprep-{os.getuid()}"
+        unpacked_models_dir.mkdir(mode=0o700)
+        stale_path = unpacked_models_dir / "amides-v1-stale"
+        stale_path.with_suffix(".pkl").touch()
+        stale_path.with_suffix(".buffers").touch()
+
+        self.object.setup()
+
+        assert not stale_path.with_suffix(".pkl").exists()
+        assert not stale_path.with_suffix(".buffers").exists()
+        assert len(list(unpacked_models_dir.glob("amides-v1-*.pkl"))) == 1
+
+    def test_setup_keeps_stale_unpacked_models_in_use(self, tmp_path):
+        unpacked_models_dir = tmp_path / f"logprep-{os.getuid()}"
+        unpacked_models_dir.mkdir(mode=0o700)
+        stale_path = unpacked_models_dir / "amides-v1-stale"
+        stale_path.with_suffix(".pkl").touch()
+
+        with FileLock(f"{stale_path}.lock"):
+            self.object.setup()
+
+        assert stale_path.with_suffix(".pkl").exists()
@@ -1,9 +1,14 @@
 # pylint: disable=missing-docstring
+from unittest import mock
+
 import numpy as np
 import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.preprocessing import MinMaxScaler
+from sklearn.svm import SVC
 
 from logprep.processor.amides.detection import (
+    DetectionModel,
     MissingModelComponentError,
     MisuseDetector,
     RuleAttributor,
@@ -14,11 +19,18 @@ from logprep.processor.amides.detection import (
 class MockVectorizer:
     """MockVectorizer to mock vectorizer for testing purposes."""
 
-    def transform(self, sample: str) -> np.array:
-        if np.array_equal(sample, np.array(["benign"])):
-            return np.array([0, 0.5, 1])
+    analyzer = "word"
+
+    def get_params(self) -> dict:
+        return {"analyzer": self.analyzer}
 
-        return np.array([0.5, 1, 0])
+    def build_analyzer(self):
+        return lambda sample: sample.split(",")
+
+    def transform(self, samples: list) -> np.array:
+        return np.array(
+            [[0, 0.5, 1] if sample == ["benign"] else [0.5, 1, 0] for sample in samples]
+        )
 
 
 class MockClassifier:
@@ -30,9 +42,12 @@ class MockClassifier:
     def decision_function(self, features: np.array) -> np.array:
         benign = np.array([0, 0.5, 1])
 
-        if np.array_equal(features, benign):
-            return np.array([-0.5])
-        return self._malicious_predict
+        return np.array(
+            [
+                -0.5 if np.array_equal(feature_vector, benign) else self._malicious_predict[0]
+                for feature_vector in features
+            ]
+        )
 
 
 class MockScaler:
@@ -55,6 +70,76 @@ def fixture_misuse_model():
     }
 
 
+@pytest.fixture(name="linear_model")
+def fixture_linear_model():
+    samples = ["c,cmd,exe,taskkill", "c,cmd,exe,whoami", "exe,svchost,k", "exe,explorer"]
+    vectorizer = TfidfVectorizer(tokenizer=lambda sample: sample.split(","), token_pattern=None)
+    features = vectorizer.fit_transform(samples)
+    clf = SVC(kernel="linear").fit(features, [1, 1, 0, 0])
+    scaler = MinMaxScaler().fit(clf.decision_function(features).reshape(-1, 1))
+    return {"clf": clf, "vectorizer": vectorizer, "scaler": scaler}
+
+
+class TestDetectionModel:
+    def test_detect_batch_linear_model_matches_classifier(self, linear_model):
+        samples = ["c,cmd,exe,taskkill", "exe,svchost", "c,unknown,whoami"]
+        features = linear_model["vectorizer"].transform(samples)
+        df_values = linear_model["clf"].decision_function(features)
+        expected = linear_model["scaler"].transform(df_values.reshape(-1, 1)).flatten()
+
+        model = DetectionModel(linear_model)
+
+        assert model._idf is not None
+        assert model._coef is not None
+        assert model._scaler is None
+        assert np.allclose(model.detect_batch(samples), expected)
+
+    def test_detect_batch_linear_model_fuses_scaler_with_scalar_attributes(self, linear_model):
+        scaler = linear_model["scaler"]
+        scaler.scale_, scaler.min_ = scaler.scale_.reshape(()), scaler.min_.reshape(())
+        samples = ["c,cmd,exe,taskkill", "exe,svchost", "c,unknown,whoami"]
+        features = linear_model["vectorizer"].transform(samples)
+        df_values = linear_model["clf"].decision_function(features)
+        expected = df_values * scaler.scale_ + scaler.min_
+
+        model = DetectionModel(linear_model)
+
+        assert model._scaler is None
+        assert np.allclose(model.detect_batch(samples), expected)
+
+    def test_detect_batch_linear_model_keeps_clipping_scaler(self, linear_model):
+        linear_model["scaler"].clip = True
+        samples = ["c,cmd,exe,taskkill", "exe,svchost", "c,unknown,whoami"]
+        features = linear_model["vectorizer"].transform(samples)
+        df_values = linear_model["clf"].decision_function(features)
+        expected = linear_model["scaler"].transform(df_values.reshape(-1, 1)).flatten()
+
+        model = DetectionModel(linear_model)
+
+        assert model._scaler is linear_model["scaler"]
+        assert np.allclose(model.detect_batch(samples), expected)
+
+    def test_detect_batch_non_linear_model_uses_classifier(self, linear_model):
+        samples = ["c,cmd,exe,taskkill", "exe,svchost", "c,unknown,whoami"]
+        train_samples = ["c,cmd,exe,taskkill", "c,cmd,exe,whoami", "exe,svchost,k", "exe,explorer"]
+        features = linear_model["vectorizer"].transform(train_samples)
+        clf = SVC(kernel="rbf").fit(features, [1, 1, 0, 0])
+        scaler = MinMaxScaler().fit(clf.decision_function(features).reshape(-1, 1))
+        linear_model.update({"clf": clf, "scaler": scaler})
+        df_values = clf.decision_function(linear_model["vectorizer"].transform(samples))
+        expected = scaler.transform(df_values.reshape(-1, 1)).flatten()
+
+        model = DetectionModel(linear_model)
+        with mock.patch.object(
+            clf, "decision_function", wraps=clf.decision_function
+        ) as mock_decision_function:
+            confidence_values = model.detect_batch(samples)
+
+        assert model._coef is None
+        mock_decision_function.assert_called_once()
+        assert np.allclose(confidence_values, expected)
+
+
 class TestMisuseDetector:
     def test_init(self, misuse_model):
         assert MisuseDetector(misuse_model, decision_threshold=0.5)
@@ -82,6 +167,22 @@ class TestMisuseDetector:
         assert detector.detect("benign") == (False, 0.0)
         assert detector.detect("malicious") == (True, 1.0)
 
+    def test_analyze(self, misuse_model):
+        detector = MisuseDetector(misuse_model, 0.5)
+        assert detector.analyze("cmd,exe") == ["cmd", "exe"]
+
+    def test_detect_analyzed(self, misuse_model):
+        detector = MisuseDetector(misuse_model, 0.5)
+        malicious, confidence_values = detector.detect_analyzed([["benign"], ["malicious"]])
+        assert malicious.tolist() == [False, True]
+        assert confidence_values.tolist() == [0.0, 1.0]
+
+    def test_detect_batch(self, misuse_model):
+        detector = MisuseDetector(misuse_model, 0.5)
+        malicious, confidence_values = detector.detect_batch(["benign", "malicious", "benign"])
+        assert malicious.tolist() == [False, True, False]
+        assert confidence_values.tolist() == [0.0, 1.0, 0.0]
+
 
 class TestRuleAttributor:
     @pytest.fixture
@@ -143,3 +244,124 @@ class TestRuleAttributor:
 
         results = attributor.attribute("malicious")
         assert results == expected
+
+    def test_attribute_batch(self, rule_models):
+        expected = [{"rule": "rule_c", "confidence": 0.9}, {"rule": "rule_a", "confidence": 0.8}]
+        attributor = RuleAttributor(
+            rule_models,
+            num_rule_attributions=2,
+        )
+
+        results = attributor.attribute_batch(["malicious", "other_malicious"])
+        assert results == [expected, expected]
+
+    def test_get_relevant_tokens(self, linear_model):
+        attributor = RuleAttributor({"rule_a": linear_model}, num_rule_attributions=1)
+        analyzed_sample = ["c", "cmd", "exe", "unknown", "whoami"]
+
+        relevant_tokens = attributor.get_relevant_tokens(analyzed_sample)
+
+        assert relevant_tokens == ("c", "cmd", "exe", "whoami")
+        assert (
+            attributor.attribute_analyzed([analyzed_sample, list(relevant_tokens)])
+            == [attributor.attribute_analyzed([list(relevant_tokens)])[0]] * 2
+        )
+
+    def test_get_relevant_tokens_without_vocabulary(self, rule_models):
+        attributor = RuleAttributor(rule_models, num_rule_attributions=2)
+
+        assert attributor.get_relevant_tokens(["malicious"]) is None
+
+    def test_attribute_analyzed_with_packed_linear_models(self, linear_model):
+        other_samples = ["c,powershell,enc", "c,cmd,whoami", "svchost,k", "explorer,exe,k"]
+        other_vectorizer = TfidfVectorizer(
+            tokenizer=lambda sample: sample.split(","), token_pattern=None
+        )
+        other_features = other_vectorizer.fit_transform(other_samples)
+        other_clf = SVC(kernel="linear").fit(other_features, [1, 1, 0, 0])
+        other_scaler = MinMaxScaler().fit(
+            other_clf.decision_function(other_features).reshape(-1, 1)
+        )
+        rule_models = {
+            "rule_a": linear_model,
+            "rule_b": {"clf": other_clf, "vectorizer": other_vectorizer, "scaler": other_scaler},
+        }
+        analyzed_samples = [
+            ["c", "cmd", "exe", "taskkill"],
+            ["c", "c", "enc", "powershell", "unknown"],
+            ["exe", "k", "svchost"],
+            ["unknown"],
+            [],
+        ]
+        attributor = RuleAttributor(rule_models, num_rule_attributions=2)
+        expected = [
+            sorted(
+                (
+                    {
+                        "rule": name,
+                        "confidence": round(model.detect_analyzed([sample])[0].item(), 3),
+                    }
+                    for name, model in attributor._rule_models.items()
+                ),
+                key=lambda attribution: -attribution["confidence"],
+            )
+            for sample in analyzed_samples
+        ]
+
+        assert attributor._packed_weights is not None
+        assert attributor.attribute_analyzed(analyzed_samples) == expected
+
+    def test_attribute_with_vectorizer_shared_with_misuse_detector(self, linear_model):
+        vectorizer = linear_model["vectorizer"]
+        misuse_detector = MisuseDetector(linear_model, decision_threshold=0.5)
+        attributor = RuleAttributor({"rule_a": linear_model}, num_rule_attributions=1)
+        _, confidence = misuse_detector.detect("c,cmd,exe,taskkill")
+
+        assert vectorizer.analyzer == "word"
+        assert attributor._analysis_params == misuse_detector.analysis_params
+        assert attributor.attribute("c,cmd,exe,taskkill") == [
+            {"rule": "rule_a", "confidence": confidence}
+        ]
+
+    def test_attribute_analyzed_without_packed_weights(self, rule_models):
+        attributor = RuleAttributor(rule_models, num_rule_attributions=2)
+
+        assert attributor._packed_weights is None
+
+    def test_attribute_empty_batch(self, linear_model):
+        attributor = RuleAttributor({"rule_a": linear_model}, num_rule_attributions=1)
+
+        assert attributor.attribute_batch([]) == []
+        assert attributor.attribute_analyzed([]) == []
+
+    def test_attribute_analyzed(self, rule_models):
+        expected = [{"rule": "rule_c", "confidence": 0.9}, {"rule": "rule_a", "confidence": 0.8}]
+        attributor = RuleAttributor(
+            rule_models,
+            num_rule_attributions=2,
+        )
+
+        assert attributor.analysis_params is not None
+        results = attributor.attribute_analyzed([["malicious"]])
+        assert results == [expected]
+
+    def test_attribute_batch_with_different_analysis_params(self, rule_models):
+        expected = [{"rule": "rule_c", "confidence": 0.9}, {"rule": "rule_a", "confidence": 0.8}]
+        rule_models["rule_b"]["vectorizer"].analyzer = "char"
+        attributor = RuleAttributor(
+            rule_models,
+            num_rule_attributions=2,
+        )
+
+        assert attributor.analysis_params is None
+        results = attributor.attribute_batch(["malicious"])
+        assert results == [expected]
+
+    def test_attribute_keeps_rule_order_for_equal_confidence_values(self, rule_models):
+        rule_models["rule_b"]["clf"] = MockClassifier(malicious_predict=0.8)
+        attributor = RuleAttributor(
+            rule_models,
+            num_rule_attributions=1,
+        )
+
+        assert attributor.attribute("malicious") == [{"rule": "rule_b", "confidence": 0.9}]
@@ -7,6 +7,7 @@ from logprep.processor.amides.features import (
     FilterDummyCharacters,
     Lowercase,
     AnyWordCharacter,
+    FilteredAnyWordCharacter,
     CommaSeparation,
     NumericValues,
     Strings,
@@ -129,6 +130,12 @@ class TestTokenizer:
         tokenizer = AnyWordCharacter()
         assert tokenizer(sample) == expected
 
+    @pytest.mark.parametrize("sample", samples + ["cmd /c shutdown -s -t 0x1234 120 ffff"])
+    def test_filtered_any_word_character(self, sample):
+        tokenizer = FilteredAnyWordCharacter(max_num_values_length=3, max_str_length=7)
+        expected = Strings(length=7)(NumericValues(length=3)(AnyWordCharacter()(sample)))
+        assert tokenizer(sample) == expected
+
     comma_separation_samples = [
         "regsvr32,exe,s,n,u,i,http,REDACTED,jpg,scrobj,dll",
         "C,set_spn,exe,q,server",